@@ -1,70 +1,468 @@
+import errno
+import io
+import os
 import shutil
 import argparse
+from collections import deque
 from pathlib import Path
 import sys
-from typing import List, Set
+import tempfile
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Set, Tuple
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def get_image_files(input_dir: Path, extensions: Set[str]) -> List[Path]:
-    """Get image files (only in first-level subdirectories) with matching extensions."""
-    return [
-        file
-        for folder in input_dir.iterdir() if folder.is_dir()
-        for file in folder.iterdir() if file.suffix.lower() in extensions
-    ]
 
+# Number of subdirectory scans submitted ahead of the one being consumed
+SCAN_PREFETCH = 2
 
-def get_unique_base(output_dir: Path, base: str, ext: str) -> str:
-    """Find a unique base name efficiently without excessive looping."""
+# Number of files handed to a worker at once, to keep per-task overhead low
+BATCH_SIZE = 256
+
+# Files between quiet-mode progress lines when the total is not known in advance
+PROGRESS_INTERVAL = 1000
+
+# Name of the aggregated ground-truth file written in manifest mode
+MANIFEST_NAME = 'manifest.tsv'
+
+# Errors that mean an in-kernel copy is not supported for this pair of files
+_FASTCOPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+# FICLONE ioctl from linux/fs.h: share the source's data blocks (copy-on-write)
+_FICLONE = 0x40049409
+_REFLINK_UNSUPPORTED = _FASTCOPY_UNSUPPORTED | {errno.ENOTTY}
+
+# Errors after which a hardlink falls back to copying (other filesystem, no hardlink support)
+_HARDLINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK}
+
+# Flags for creating output files, as done by open(..., 'wb')
+_CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+# (path, stem, lowercase extension, folder name, UTF-8 encoded folder name, size in bytes or None)
+ImageEntry = Tuple[str, str, str, str, bytes, Optional[int]]
+
+
+def _scan_folder(folder_path: str, folder_name: str, extensions: Tuple[str, ...],
+                 with_size: bool = False) -> List[ImageEntry]:
+    """Get the regular image files with matching extensions in a single subdirectory.
+
+    The file size costs a stat() call per file, so it is only looked up if with_size is set.
+    """
+    label_bytes = folder_name.encode('utf-8')
+    image_files = []
+    with os.scandir(folder_path) as files:
+        for entry in files:
+            name = entry.name
+            name_lower = name.lower()
+            if not name_lower.endswith(extensions):
+                continue
+            dot = name_lower.rfind('.')
+            # Like Path.suffix, a leading dot (e.g. ".png") does not start an extension.
+            # is_file() uses the file type from the directory listing (no stat unless it is a symlink)
+            if dot > 0 and entry.is_file():
+                size = entry.stat().st_size if with_size else None
+                image_files.append((entry.path, name[:dot], name_lower[dot:], folder_name, label_bytes, size))
+    return image_files
+
+
+def get_image_files(input_dir: Path, extensions: Tuple[str, ...], executor: Optional[Executor] = None,
+                    with_size: bool = False) -> Iterator[ImageEntry]:
+    """Yield image files (only in first-level subdirectories) with matching extensions.
+
+    If an executor is given, up to SCAN_PREFETCH subdirectories are scanned on it ahead of the
+    one being consumed, so that copy jobs submitted meanwhile are not queued behind every scan.
+    """
+    folders = []
+    with os.scandir(input_dir) as entries:
+        for folder in entries:
+            if folder.is_dir():
+                # Every image of a folder shares one interned label string
+                folders.append((folder.path, sys.intern(folder.name)))
+
+    if executor is None:
+        for folder_path, folder_name in folders:
+            yield from _scan_folder(folder_path, folder_name, extensions, with_size)
+        return
+
+    pending = deque()
+    for folder_path, folder_name in folders:
+        pending.append(executor.submit(_scan_folder, folder_path, folder_name, extensions, with_size))
+        if len(pending) > SCAN_PREFETCH:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def get_existing_stems(output_dir: Path) -> Set[str]:
+    """Collect the stems of all entries already present in the output directory.
+
+    Only the names from the directory listing are used, so no file is stat'ed. The stem of
+    a ground-truth file is taken without the whole .gt.txt suffix, so that a .gt.txt left
+    without its image still reserves the name.
+    """
+    stems = set()
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            name = entry.name
+            if name.endswith('.gt.txt'):
+                stems.add(name[:-len('.gt.txt')])
+            else:
+                stems.add(os.path.splitext(name)[0])
+    return stems
+
+
+def get_unique_base(existing_stems: Set[str], base: str) -> str:
+    """Find a unique base name by checking against the in-memory set of used stems."""
     candidate = base
     counter = 1
-    existing_files = {f.stem for f in output_dir.glob("*")}  # Cache existing filenames for faster lookup
 
-    while candidate in existing_files:
+    while candidate in existing_stems:
         candidate = f"{base}_{counter}"
         counter += 1
 
     return candidate
 
 
-def generate_gt_from_folders(input_dir: Path, output_dir: Path) -> int:
-    """Generate .gt.txt files for each image where the text file contains the parent folder's name."""
-    print("Ground-Truth generation beginning...")
-    output_dir.mkdir(parents=True, exist_ok=True)
+def _open_output(name: str, dir_fd: Optional[int]) -> int:
+    """Create/truncate an output file, relative to dir_fd when one is given."""
+    if dir_fd is None:
+        return os.open(name, _CREATE_FLAGS, 0o644)
+    return os.open(name, _CREATE_FLAGS, 0o644, dir_fd=dir_fd)
+
+
+def _remove_output(name: str, dir_fd: Optional[int]) -> None:
+    """Remove a partially written output file, ignoring errors (it may not exist)."""
+    try:
+        if dir_fd is None:
+            os.unlink(name)
+        else:
+            os.unlink(name, dir_fd=dir_fd)
+    except OSError:
+        pass
+
+
+def _reflink(infd: int, outfd: int) -> None:
+    """Clone the contents of infd into outfd (btrfs, xfs and other CoW filesystems)."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    fcntl.ioctl(outfd, _FICLONE, infd)
+
+
+def _copy_contents(fsrc, fdst, reflink: str) -> None:
+    """Copy from fsrc to the empty fdst, see _fastcopy."""
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    if reflink != 'never':
+        try:
+            _reflink(infd, outfd)
+            return
+        except OSError as e:
+            if reflink == 'always' or e.errno not in _REFLINK_UNSUPPORTED:
+                raise
+    # Each primitive falls through to the next one if it is unsupported or copies nothing
+    # (known-empty sources are handled by _fastcopy); a partial copy is an error
+    if hasattr(os, 'copy_file_range'):
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(infd, outfd, 1 << 30)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _FASTCOPY_UNSUPPORTED:
+                raise
+        if copied:
+            return
+    if sys.platform.startswith('linux'):
+        copied = 0
+        try:
+            while True:
+                n = os.sendfile(outfd, infd, copied, 1 << 30)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _FASTCOPY_UNSUPPORTED:
+                raise
+        if copied:
+            return
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def _fastcopy(src: str, dst: str, dst_dir_fd: Optional[int] = None, reflink: str = 'auto',
+              size: Optional[int] = None) -> None:
+    """Copy file contents without going through user space where possible.
 
-    image_extensions = {'.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif'}
-    image_files = get_image_files(input_dir, image_extensions)
+    Depending on reflink ('auto', 'always' or 'never', as for cp) a copy-on-write clone is tried
+    first, followed by copy_file_range and sendfile. If the source size is already known to be
+    zero, only the empty destination is created (except with reflink='always', which still
+    requires the clone to succeed). If copying fails, the destination is removed again.
+    """
+    if size == 0 and reflink != 'always':
+        os.close(_open_output(dst, dst_dir_fd))
+        return
+    with open(src, 'rb') as fsrc:
+        outfd = _open_output(dst, dst_dir_fd)
+        try:
+            with open(outfd, 'wb') as fdst:
+                _copy_contents(fsrc, fdst, reflink)
+        except BaseException:
+            _remove_output(dst, dst_dir_fd)
+            raise
+
+
+def place_image(src: str, dst: str, dst_dir_fd: Optional[int] = None, link: str = 'copy',
+                reflink: str = 'auto', size: Optional[int] = None) -> None:
+    """Put the image at dst by copying it, or as a symlink or hardlink if link says so."""
+    dir_fd_kwargs = {} if dst_dir_fd is None else {'dir_fd': dst_dir_fd}
+    if link == 'symlink':
+        os.symlink(os.path.abspath(src), dst, **dir_fd_kwargs)
+        return
+    if link == 'hardlink':
+        try:
+            os.link(src, dst, dst_dir_fd=dst_dir_fd)
+            return
+        except OSError as e:
+            if e.errno not in _HARDLINK_UNSUPPORTED:
+                raise
+    _fastcopy(src, dst, dst_dir_fd, reflink, size)
+
+
+def write_gt_pair(file_path: str, image_name: str, label_bytes: bytes, txt_name: Optional[str], size: Optional[int],
+                  out_dirfd: Optional[int], link: str = 'copy', reflink: str = 'auto') -> None:
+    """Place the image and then write its ground-truth text file (unless collected in a manifest).
+
+    Output names are relative to out_dirfd, or full paths if it is None. The label is only
+    written once the image is in place, and neither file is left behind if a step fails.
+    """
+    place_image(file_path, image_name, out_dirfd, link, reflink, size)
+    if txt_name is not None:
+        try:
+            fd = _open_output(txt_name, out_dirfd)
+            try:
+                os.write(fd, label_bytes)
+            finally:
+                os.close(fd)
+        except BaseException:
+            _remove_output(txt_name, out_dirfd)
+            _remove_output(image_name, out_dirfd)
+            raise
+
+
+def write_gt_batch(batch: List[Tuple[str, str, bytes, Optional[str], Optional[int]]], out_dirfd: Optional[int],
+                   link: str, reflink: str) -> List[Optional[OSError]]:
+    """Run write_gt_pair for a batch of jobs, returning the error (or None) for each one."""
+    errors = []
+    for job in batch:
+        try:
+            write_gt_pair(*job, out_dirfd, link, reflink)
+            errors.append(None)
+        except OSError as e:
+            errors.append(e)
+    return errors
+
+
+def report_batch(batch_info: List[Tuple[str, str, str]], errors: List[Optional[OSError]],
+                 manifest: Optional[io.StringIO], quiet: bool, done: int = 0, total: Optional[int] = None) -> int:
+    """Report the outcome of a finished batch and return the number of files processed.
+
+    In quiet mode, a progress line is printed instead of one line per file whenever another 1% of
+    the total is done, with done being the number of files finished before this batch. If the
+    total is unknown because the input is still being scanned, progress is reported every
+    PROGRESS_INTERVAL files.
+    """
+    processed, failed = [], []
+    for (file_path, folder_name, unique_base), error in zip(batch_info, errors):
+        if error is None:
+            if manifest is not None:
+                manifest.write(f"{unique_base}\t{folder_name}\n")
+            if not quiet:
+                processed.append(f"Processed: {os.path.basename(file_path)} -> {folder_name}\n")
+        else:
+            failed.append(f"Error processing {file_path}: {error}\n")
+    # Report a whole batch with one write instead of one print per file
+    if processed:
+        sys.stdout.write(''.join(processed))
+    if failed:
+        sys.stderr.write(''.join(failed))
+    if quiet:
+        step = max(1, total // 100) if total else PROGRESS_INTERVAL
+        now_done = done + len(batch_info)
+        if now_done // step > done // step:
+            if total:
+                print(f"Progress: {now_done * 100 // total}% ({now_done}/{total} files)")
+            else:
+                print(f"Progress: {now_done} files")
+    return errors.count(None)
+
+
+def _nearest_existing(path: Path) -> Path:
+    """Return path or, if it does not exist yet, its nearest existing parent."""
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
 
+
+def get_free_space(path: Path) -> int:
+    """Get the free space in bytes on the filesystem holding path (or its nearest existing parent)."""
+    return shutil.disk_usage(_nearest_existing(path)).free
+
+
+def can_reflink(src: str, dest_dir: Path) -> bool:
+    """Check whether src can be cloned onto the filesystem of dest_dir (or its nearest existing parent).
+
+    The clone goes into an anonymous temporary file, so nothing is left behind.
+    """
+    try:
+        with open(src, 'rb') as fsrc, tempfile.TemporaryFile(dir=_nearest_existing(dest_dir)) as ftmp:
+            _reflink(fsrc.fileno(), ftmp.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def generate_gt_from_folders(input_dir: Path, output_dir: Path, concurrency: Optional[int] = None,
+                             manifest_mode: bool = False, link: str = 'copy', reflink: str = 'auto',
+                             quiet: bool = False, dry_run: bool = False, force: bool = False) -> int:
+    """Generate .gt.txt files for each image where the text file contains the parent folder's name.
+
+    In manifest mode, a single MANIFEST_NAME file with one "<base>\t<label>" line per image
+    is written instead of the individual .gt.txt files. If quiet is set, only errors, coarse
+    progress and the final summary are reported.
+
+    When images are copied without reflink='always', the whole input is listed first and its
+    total size is checked against the free space of the output filesystem, unless force is set.
+    Running short aborts, unless reflink is 'auto' and a test clone of the first image onto
+    the output filesystem succeeds, since clones need no extra space. A dry run only reports
+    what would be processed.
+    """
+    print("Ground-Truth generation beginning...")
+
+    image_extensions = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif')
+    manifest = io.StringIO() if manifest_mode else None
     total_files = 0
+    done_files = 0
+    max_workers = concurrency if concurrency is not None else min(32, (os.cpu_count() or 1) * 4)
 
-    for file_path in image_files:
-        folder_name = file_path.parent.name
-        base_name = file_path.stem
-        ext = file_path.suffix.lower()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        check_space = dry_run or (link == 'copy' and reflink != 'always' and not force)
+        image_files = get_image_files(input_dir, image_extensions, executor, with_size=check_space)
+        listed_files = None
 
-        unique_base = get_unique_base(output_dir, base_name, ext)
-        dest_image = output_dir / f"{unique_base}{ext}"
-        txt_filepath = output_dir / f"{unique_base}.gt.txt"
+        if check_space:
+            # All sizes are needed before the first copy, so scanning no longer overlaps copying
+            image_files = list(image_files)
+            listed_files = len(image_files)
+            total_bytes = sum(entry[5] for entry in image_files)
+            free_bytes = get_free_space(output_dir)
+            if dry_run:
+                print(f"Dry run: would process {len(image_files)} image files "
+                      f"({total_bytes / 2**20:.1f} MiB, {free_bytes / 2**20:.1f} MiB free in output directory).")
+                return len(image_files)
+            if total_bytes > free_bytes * 0.95:
+                shortage = (f"images need {total_bytes / 2**20:.1f} MiB but only {free_bytes / 2**20:.1f} MiB "
+                            f"are free in {output_dir}")
+                if reflink == 'auto' and can_reflink(image_files[0][0], output_dir):
+                    print(f"Warning: {shortage}; continuing because the images can be reflinked.", file=sys.stderr)
+                else:
+                    print(f"Error: {shortage}. Use --force to copy anyway.", file=sys.stderr)
+                    return 0
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        existing_stems = get_existing_stems(output_dir)  # Scan the output directory only once
+        # Open the output directory once so that files are created relative to it
+        # instead of resolving the full path for every file (where supported)
+        if os.open in os.supports_dir_fd:
+            out_dirfd = os.open(output_dir, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            out_prefix = ''
+        else:
+            out_dirfd = None
+            out_prefix = os.fspath(output_dir) + os.sep
 
         try:
-            txt_filepath.write_text(folder_name, encoding='utf-8')
-            shutil.copy(file_path, dest_image)  # Faster than copy2()
-            total_files += 1
-            print(f"Processed: {file_path.name} -> {folder_name}")
-        except (IOError, OSError) as e:
-            print(f"Error processing {file_path}: {e}", file=sys.stderr)
+            # Unless the input was already listed for the free-space check, images are handed out
+            # as their folder is scanned, with only a few scans and batches in flight at a time
+            # Batches are reported in submission order so that the output and manifest are deterministic
+            in_flight = deque()
+            batch, batch_info = [], []
+            for file_path, base_name, ext, folder_name, label_bytes, size in image_files:
+                # Names are resolved sequentially so that the output stays deterministic
+                unique_base = get_unique_base(existing_stems, base_name)
+                existing_stems.add(unique_base)
+                image_name = f"{out_prefix}{unique_base}{ext}"
+                txt_name = None if manifest_mode else f"{out_prefix}{unique_base}.gt.txt"
+
+                batch.append((file_path, image_name, label_bytes, txt_name, size))
+                batch_info.append((file_path, folder_name, unique_base))
+                if len(batch) >= BATCH_SIZE:
+                    in_flight.append((executor.submit(write_gt_batch, batch, out_dirfd, link, reflink), batch_info))
+                    batch, batch_info = [], []
+                    if len(in_flight) >= 2 * max_workers:
+                        future, done_info = in_flight.popleft()
+                        total_files += report_batch(done_info, future.result(), manifest, quiet,
+                                                    done_files, listed_files)
+                        done_files += len(done_info)
+            if batch:
+                in_flight.append((executor.submit(write_gt_batch, batch, out_dirfd, link, reflink), batch_info))
+
+            while in_flight:
+                future, done_info = in_flight.popleft()
+                total_files += report_batch(done_info, future.result(), manifest, quiet, done_files, listed_files)
+                done_files += len(done_info)
+        finally:
+            # Batches still queued after an error use out_dirfd, so wait for them before closing it
+            executor.shutdown(wait=True)
+            if out_dirfd is not None:
+                os.close(out_dirfd)
+
+    if manifest is not None:
+        # Append so that repeated runs into the same output directory keep earlier entries
+        with open(output_dir / MANIFEST_NAME, 'a', encoding='utf-8', buffering=1 << 20) as f:
+            f.write(manifest.getvalue())
 
     print(f"Done! Processed {total_files} image files.")
     return total_files
 
 
+def positive_int(value: str) -> int:
+    """argparse type for options that need a number greater than zero."""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(description="Generate .gt.txt files from folder names for Tesseract training")
     parser.add_argument('input_dir', type=Path, help='Input directory containing subfolders with images')
     parser.add_argument('output_dir', type=Path, help='Output directory')
+    parser.add_argument('-j', '--concurrency', type=positive_int, metavar='N',
+                        help='Number of parallel copy workers (default: 4 per CPU, at most 32)')
+    parser.add_argument('--manifest-mode', action='store_true',
+                        help=f'Write a single {MANIFEST_NAME} with "<base>\\t<label>" lines instead of one .gt.txt per image')
+    parser.add_argument('--link', choices=['copy', 'symlink', 'hardlink'], default='copy',
+                        help='How to place images in the output directory; hardlinks fall back to copies '
+                             'across filesystems (default: %(default)s)')
+    parser.add_argument('--reflink', choices=['auto', 'always', 'never'], default='auto',
+                        help='Clone images copy-on-write where the filesystem supports it (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help=f"Report progress every 1%% (every {PROGRESS_INTERVAL} files while the total is "
+                             "unknown) instead of every processed file")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="Only report how many images would be processed and how much space they need")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Don't check the free space in the output directory before copying. Without it, "
+                             "copying (--link=copy, --reflink other than always) only starts once the whole "
+                             "input has been listed, and the run is aborted if the images do not fit, unless "
+                             "--reflink=auto and they can be cloned onto the output filesystem")
     args = parser.parse_args()
 
-    count = generate_gt_from_folders(args.input_dir.resolve(), args.output_dir.resolve())
+    count = generate_gt_from_folders(args.input_dir.resolve(), args.output_dir.resolve(), args.concurrency,
+                                     args.manifest_mode, args.link, args.reflink, args.quiet,
+                                     args.dry_run, args.force)
     if count == 0:
         sys.exit(1)
 